@@ -8,9 +8,10 @@ __version__ = "1.1.0"
 
 import os, sys, logging, signal, hashlib, sqlite3
 import contextlib, functools, urllib.parse
-import mailbox, email.policy
+import threading, queue, concurrent.futures
+import mailbox, email.message, email.parser, email.policy
 import imapclient
-import datetime
+import datetime, time
 
 
 # register a signal handler for clean(er) exits
@@ -40,17 +41,35 @@ class Mailserver:
         if b"OK Gimap ready for requests" in self.client.welcome:
           self.compat = True
           self.log(INFO, "this is a Gmail server")
+        if self.client.has_capability("CONDSTORE"):
+          self.condstore = True
+          self.log(VERBOSE, "server supports CONDSTORE")
 
     # is this an exchange or gmail server?
     compat = False
 
+    # does the server keep modification sequences (RFC 7162)?
+    condstore = False
+
     # stubs for use as a context manager
     def __enter__(self):
         return self
     def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    # log out and close the connection
+    def close(self):
         try: self.client.logout()
         except: pass
 
+    # check that an idle connection still responds
+    def alive(self):
+        try: self.client.noop()
+        except Exception as err:
+            self.log(INFO, "connection dropped: {!r}".format(err))
+            return False
+        return True
+
     # list available folders
     def ls(self, directory="", pattern="*"):
         return [f[2] for f in self.client.list_folders(directory, pattern)]
@@ -59,17 +78,40 @@ class Mailserver:
     def cd(self, folder):
         return self.client.select_folder(folder, readonly=True)
 
-    # get new mail uids in current folder, starting with uid start
-    def mails(self, start=1, start_date=None, end_date=None):
+    # servers may drop idle connections after 30 minutes, see RFC 2177
+    IDLETIMEOUT = 29*60
+
+    # wait up to timeout seconds in IDLE on a folder; return True as soon
+    # as the server announces new messages
+    def idle(self, folder, timeout):
+        self.cd(folder)
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self.log(VERBOSE, "IDLE in {} for {:.0f} seconds".format(folder, min(remaining, self.IDLETIMEOUT)))
+            self.client.idle()
+            try: responses = self.client.idle_check(min(remaining, self.IDLETIMEOUT))
+            finally: self.client.idle_done()
+            if any(r[1] == b"EXISTS" for r in responses if len(r) > 1):
+                return True
+
+    # search criteria templates; IMAP date format is "01-Jan-2000"
+    UIDRANGE, SINCE, BEFORE = "UID %d:*", "SINCE %d-%b-%Y", "BEFORE %d-%b-%Y"
+    MODSEQ = "MODSEQ %d"
+
+    # get new mail uids in current folder, starting with uid start; with a
+    # modseq only messages added or changed after it are returned
+    def mails(self, start=1, start_date=None, end_date=None, modseq=None):
         # build search criteria
-        criteria = ["UID {}:*".format(start)]
+        criteria = [self.UIDRANGE % start]
+        if modseq is not None and self.condstore:
+            criteria.append(self.MODSEQ % (modseq + 1))
         if start_date:
-            # IMAP date format is "01-Jan-2000"
-            start_date_str = start_date.strftime('%d-%b-%Y')
-            criteria.append('SINCE {}'.format(start_date_str))
+            criteria.append(start_date.strftime(self.SINCE))
         if end_date:
-            end_date_str = end_date.strftime('%d-%b-%Y')
-            criteria.append('BEFORE {}'.format(end_date_str))
+            criteria.append(end_date.strftime(self.BEFORE))
 
         # join criteria with space
         search_criteria = ' '.join(criteria)
@@ -79,6 +121,8 @@ class Mailserver:
     # a sufficiently large firstflight chunk can fetch messages in one go
     FIRSTFLIGHT =      64*1024 # 64 KB
     NEXTCHUNKS  = 10*1024*1024 # 10 MB
+    # remaining chunks grow geometrically up to this size for very large messages
+    MAXCHUNKS   = 16*1024*1024 # 16 MB
 
     # commonly useful data selectors for fetch
     # https://tools.ietf.org/html/rfc3501#section-6.4.5
@@ -91,11 +135,74 @@ class Mailserver:
         self.log(VERBOSE, "FETCH {} [{}]".format(uid, data))
         return self.client.fetch(uid, data, modifiers)[uid]
 
-    # retrieve a specific message by uid; return header and body generator
-    def message(self, uid, firstflight=FIRSTFLIGHT, chunk=NEXTCHUNKS):
-
-        # fetch message header, size and "firstflight" chunk
-        msg = self.fetch(uid, [self.SIZE, self.HEADER, self.TEXTF % (0, firstflight)])
+    # number of uids whose headers are requested in a single fetch command
+    # and upper bound on the firstflight data requested by one batch
+    BATCHSIZE   = 200
+    BATCHBYTES  = 16*1024*1024 # 16 MB
+
+    # maximum length of the uid set in one command; some servers reject long lines
+    SETBYTES    = 900
+
+    # split a list of uids into batches of at most size uids, whose
+    # comma-separated sequence set also stays below SETBYTES
+    def batches(self, uids, size=BATCHSIZE):
+        part, length = [], 0
+        for uid in uids:
+            n = len(str(uid)) + 1
+            if part and (len(part) >= size or length + n > self.SETBYTES):
+                yield part
+                part, length = [], 0
+            part.append(uid)
+            length += n
+        if part:
+            yield part
+
+    # limits for an adaptive firstflight; compat servers truncate large partials
+    MAXFLIGHT   =  4*1024*1024 #  4 MB
+    COMPATFLIGHT = 1*1024*1024 #  1 MB
+
+    # choose a firstflight chunk that fetches ~95% of messages in one go,
+    # based on the sizes of the messages that are about to be fetched
+    def firstflight(self, sizes, default=FIRSTFLIGHT):
+        sizes = sorted(sizes)
+        if not sizes:
+            return default
+        p95 = sizes[int(0.95 * (len(sizes) - 1))]
+        limit = self.COMPATFLIGHT if self.compat else self.MAXFLIGHT
+        flight = max(default, min(limit, p95))
+        self.log(VERBOSE, "firstflight chunk size {}".format(flight))
+        return flight
+
+    # fetch only size and header for many uids with one command per batch;
+    # yields the uids and response dict of every batch
+    def headers(self, uids, batch=BATCHSIZE):
+        for part in self.batches(uids, batch):
+            self.log(VERBOSE, "FETCH {} uids [{}..{}] headers".format(len(part), part[0], part[-1]))
+            yield part, self.client.fetch(part, [self.SIZE, self.HEADER])
+
+    # retrieve many messages with one fetch command per batch of uids; yields uid,
+    # header, size and body generator for every message; headers already fetched
+    # with headers() above can be passed to only request the body
+    def messages(self, uids, firstflight=FIRSTFLIGHT, chunk=NEXTCHUNKS, batch=BATCHSIZE, headers=None):
+        batch = max(1, min(batch, self.BATCHBYTES // firstflight))
+        data = [self.TEXTF % (0, firstflight)]
+        if headers is None:
+            data = [self.SIZE, self.HEADER] + data
+        for part in self.batches(uids, batch):
+            self.log(VERBOSE, "FETCH {} uids [{}..{}]".format(len(part), part[0], part[-1]))
+            response = self.client.fetch(part, data)
+            for uid in part:
+                if uid not in response:
+                    self.log(VERBOSE, "message uid {} vanished during fetch".format(uid))
+                    continue
+                msg = response[uid]
+                if headers is not None:
+                    msg = dict(headers[uid])
+                    msg.update(response[uid])
+                yield (uid,) + self.partials(uid, msg, chunk)
+
+    # unpack a firstflight response; return header, size and body generator
+    def partials(self, uid, msg, chunk=NEXTCHUNKS):
         size, header, text = msg[self.SIZE], msg[self.HEADER], msg[self.TEXT % (0)]
 
         # function to dynamically fetch and yield message parts as necessary
@@ -106,16 +213,22 @@ class Mailserver:
                 self.log(VERBOSE, "compat: received an empty message")
                 yield header
                 return
-            pos = len(text)
-            yield header + text
+            pos, length = len(text), chunk
+            # yield separately, the writer takes chunks as they are without joining
+            yield header
+            yield text
             while size > (len(header) + pos):
-                self.log(VERBOSE, "next partial: <{}.{}>".format(pos, chunk))
-                part = self.fetch(uid, [self.TEXTF % (pos, chunk)])[self.TEXT % (pos)]
+                # do not ask beyond the reported size, unless it is unreliable
+                if not self.compat:
+                    length = min(length, size - len(header) - pos)
+                self.log(VERBOSE, "next partial: <{}.{}>".format(pos, length))
+                part = self.fetch(uid, [self.TEXTF % (pos, length)])[self.TEXT % (pos)]
                 # exchange+gmail report unreliable size and may return None body early
                 if self.compat and (part is None or len(part) == 0):
                     self.log(VERBOSE, "compat: premature end of message, wrong size reported")
                     return
                 pos += len(part)
+                length = min(length * 4, self.MAXCHUNKS)
                 yield part
 
         return header, size, generator
@@ -126,49 +239,122 @@ class Mailserver:
 class Maildir(mailbox.Maildir):
     colon = "!" # should never be needed
 
+    # anonymous temporary files can be linked into place through /proc on linux
+    TMPFILE = hasattr(os, "O_TMPFILE") and os.path.isdir("/proc/self/fd")
+
     # greatly simplified file writer that uses content-addressable
-    # filenames through a digest of the raw message header
-    def add(self, message, uid=0):
+    # filenames through a digest of the raw message header; the content
+    # is either streamed from an iterable of chunks or serialized message
+    def add(self, message, uid=0, chunks=None):
         if not isinstance(message, Message):
             raise TypeError("message must be a Message object")
         # hash header to get content-addressable filename
         name = message.uniqname(uid)
         path = os.path.join(self._path, "cur", name)
-        try: os.stat(path)
-        except FileNotFoundError:
-            file = mailbox._create_carefully(path)
-            file.write(message.as_bytes())
-            file.close()
-            return name
-        raise FileExistsError("a message with this header digest exists: {}".format(name))
-
-
-
-# Message is a wrapper around MaildirMessage with necessary properties
-# applied to normalize it and compute stable header digests.
-class Message(mailbox.MaildirMessage):
-    def __init__(self, message):
-        super().__init__(message)
+        try: self.__write(path, [message.as_bytes()] if chunks is None else chunks)
+        except FileExistsError:
+            raise FileExistsError("a message with this header digest exists: {}".format(name))
+        return name
+
+    # write chunks to an anonymous file first and then link it to path, so the message
+    # only appears once it is complete; an existing file raises FileExistsError
+    def __write(self, path, chunks):
+        if Maildir.TMPFILE:
+            try: fd = os.open(os.path.dirname(path), os.O_TMPFILE | os.O_RDWR, 0o666)
+            except OSError: Maildir.TMPFILE = False # filesystem does not support it
+            else:
+                try:
+                    for chunk in chunks:
+                        self.__writeall(fd, chunk)
+                    try: return os.link("/proc/self/fd/{}".format(fd), path)
+                    except FileExistsError: raise
+                    except OSError: Maildir.TMPFILE = False # cannot link through /proc
+                    # chunks are consumed already, copy what was written
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    chunks = iter(functools.partial(os.read, fd, 1024*1024), b"")
+                    return self.__write(path, chunks)
+                finally:
+                    os.close(fd)
+        # otherwise write a named file in tmp/ and link it into place when complete,
+        # so a killed process can only leave a partial file behind in tmp/
+        tmp = os.path.join(self._path, "tmp", "{}.{}.{}".format(
+            os.path.basename(path), os.getpid(), threading.get_ident()))
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | self.BINARY, 0o666)
+        try:
+            try:
+                for chunk in chunks:
+                    self.__writeall(fd, chunk)
+            finally:
+                os.close(fd)
+            os.link(tmp, path)
+        finally:
+            os.remove(tmp)
+
+    # unbuffered writes on raw file descriptors, which must not translate newlines
+    BINARY = getattr(os, "O_BINARY", 0)
+
+    # write a complete chunk without copying it, retrying short writes
+    @staticmethod
+    def __writeall(fd, chunk):
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(fd, view):]
+
+
+
+# Message is a thin wrapper around the raw bytes of a message as received
+# from the server, which computes stable header digests.
+class Message:
+    __slots__ = ("raw", "_digest", "_header")
+
+    def __init__(self, raw):
+        # serialize parsed messages with \r\n and long lines
+        if isinstance(raw, email.message.Message):
+            raw = raw.as_bytes(policy=email.policy.HTTP)
+        self.raw = raw
         self._digest = self._header = None
-        # apply policy to use \r\n and long lines
-        self.policy = email.policy.HTTP
 
-    # slice and cache the header as bytes
+    # the exact bytes to store on disk
+    def as_bytes(self):
+        return self.raw
+
+    # find the end of the header in raw bytes, including the empty line;
+    # a single scan per separator, the second stops where the first matched
+    @staticmethod
+    def headerend(raw):
+        end = raw.find(b"\r\n\r\n")
+        end = end + 4 if end >= 0 else None
+        lf = raw.find(b"\n\n", 0, end)
+        return lf + 2 if lf >= 0 else end
+
+    # shared compat32 parser, the same that email.message_from_bytes creates per call
+    PARSER = email.parser.BytesParser()
+
+    # normalize a raw header with the policy used for digests since v1.0: \r\n
+    # line endings and long lines; this only parses the header, not the body
+    @classmethod
+    def normalize(cls, raw):
+        message = cls.PARSER.parsebytes(raw, headersonly=True).as_bytes(policy=email.policy.HTTP)
+        return message[:message.index(b"\r\n\r\n")+4]
+
+    # slice, normalize and cache the header as bytes
     def header(self):
         if not self._header:
-            message = self.as_bytes()
-            self._header = message[:message.index(b"\r\n\r\n")+4]
+            self._header = self.normalize(self.raw[:self.headerend(self.raw)])
         return self._header
 
+    # hash function for header digests, see Archive.DIGESTVERSION
+    DIGEST = hashlib.sha224
+
     # compute and cache the header digest
     def digest(self):
         if not self._digest:
-            self._digest = hashlib.sha224(self.header()).digest()
+            self._digest = self.DIGEST(self.header()).digest()
         return self._digest
 
     # return a filename for storage
     def uniqname(self, uid=0):
-        return "{:010d}-{}.eml".format(uid, self.digest().hex())
+        return "%010d-%s.eml" % (uid, self.digest().hex())
 
 
 
@@ -183,7 +369,12 @@ class Archive:
         self.path = os.path.abspath(os.path.expanduser(path))
         self.__check_oldversion()
         os.makedirs(self.path, exist_ok=True)
-        self.db = sqlite3.connect(os.path.join(self.path, "index.db"))
+        # autocommit mode, transactions are managed explicitly in transaction();
+        # the connection is shared by folder workers and guarded by self.lock
+        self.db = sqlite3.connect(os.path.join(self.path, "index.db"),
+            isolation_level=None, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.db.executescript(self.PRAGMAS)
         self.db.execute("""
         CREATE TABLE IF NOT EXISTS folders (
             id          INTEGER     PRIMARY KEY,
@@ -197,9 +388,35 @@ class Archive:
             uid         INTEGER     NOT NULL,
             FOREIGN KEY (folder) REFERENCES folders (id)
         )""")
-        self.db.commit()
+        self.__check_digestversion()
+        self.__check_columns()
+        # a fresh archive is filled in bulk first, so only index it on close
+        self._deferindex = self.db.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is None
+        if not self._deferindex:
+            self.__index()
         self.log(INFO, "opened archive in {}".format(self.path))
         self.quoting = quoting
+        # pending index writes, flushed in a single transaction
+        self._folderids = { }
+        self._lastseen = { }
+        self._modseqs = { }
+        self._pending = [ ]
+        self._pendingdigests = set()
+        # opened maildirs per folder
+        self._inboxes = { }
+        self._inboxlock = threading.Lock()
+
+    # connection tuning: page_size only applies to a fresh database and must
+    # be set before switching to write-ahead logging
+    PRAGMAS = """
+        PRAGMA page_size = 4096;
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = NORMAL;
+        PRAGMA temp_store = MEMORY;
+        PRAGMA cache_size = -65536;
+        PRAGMA mmap_size = 268435456;
+        PRAGMA busy_timeout = 60000;
+    """
 
     # check if this archive was created with a previous version
     def __check_oldversion(self):
@@ -208,53 +425,186 @@ class Archive:
             self.log(ERROR, "archive was created with a previous version")
             raise AssertionError("incompatible archive format")
 
+    # version of the digest scheme in the index, stored as the database user_version:
+    # 1 = sha224 over the normalized message header
+    DIGESTVERSION = 1
+
+    # refuse archives with an unknown digest scheme, mark older ones with the current one
+    def __check_digestversion(self):
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version > self.DIGESTVERSION:
+            self.log(INFO, "index.db has digest version {}".format(version))
+            self.log(ERROR, "archive was created with a newer version")
+            raise AssertionError("incompatible archive format")
+        if version < self.DIGESTVERSION:
+            self.db.execute("PRAGMA user_version = {:d}".format(self.DIGESTVERSION))
+
+    # add columns that were introduced after the initial schema
+    def __check_columns(self):
+        columns = [c[1] for c in self.db.execute("PRAGMA table_info(folders)")]
+        for column in ("uidvalidity", "modseq"):
+            if column not in columns:
+                self.db.execute("ALTER TABLE folders ADD COLUMN {} INTEGER".format(column))
+
+    # covering folder-scoped index, so digest prefetches and uid ranges never read the table
+    def __index(self):
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_messages_folder_uid ON messages (folder, uid, digest)")
+
     # stubs for use as a context manager
     def __enter__(self):
         return self
     def __exit__(self, exc_type, exc_value, tb):
         try:
-            self.db.commit()
+            self.flush()
+            if self._deferindex:
+                self.__index()
+                self.db.execute("ANALYZE")
+            self.db.execute("PRAGMA optimize")
             self.db.close()
         except: pass
 
+    # number of stored messages after which pending index writes are flushed
+    BATCHSIZE = 500
+
+    # explicit transaction on the autocommit connection
+    @contextlib.contextmanager
+    def transaction(self):
+        self.db.execute("BEGIN")
+        try:
+            yield self.db
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    # write all pending messages and lastseen uids to the index in one transaction
+    def flush(self):
+        with self.lock:
+            with self.transaction():
+                self.db.executemany("""INSERT INTO folders (folder, lastseen) VALUES (?, ?)
+                    ON CONFLICT (folder) DO UPDATE SET lastseen = excluded.lastseen""", self._lastseen.items())
+                self.db.executemany("INSERT INTO messages (digest, folder, uid) VALUES (?, ?, ?)", self._pending)
+                self.db.executemany("""INSERT INTO folders (folder, uidvalidity, modseq) VALUES (?, ?, ?)
+                    ON CONFLICT (folder) DO UPDATE SET uidvalidity = excluded.uidvalidity,
+                    modseq = excluded.modseq""", ((f, v, m) for f, (v, m) in self._modseqs.items()))
+            if self._pending:
+                self.log(VERBOSE, "flushed {} messages to index".format(len(self._pending)))
+            # keep digests reserved by stores that are still writing
+            self._pendingdigests.difference_update(digest for digest, _, _ in self._pending)
+            self._lastseen.clear()
+            self._modseqs.clear()
+            self._pending.clear()
+
+    # get the row id of a folder once, creating it if necessary
+    def folderid(self, folder):
+        with self.lock:
+            if folder not in self._folderids:
+                self.db.execute("INSERT OR IGNORE INTO folders (folder) VALUES (?)", (folder,))
+                result = self.db.execute("SELECT id FROM folders WHERE folder = ?", (folder,)).fetchone()
+                self._folderids[folder] = result[0]
+            return self._folderids[folder]
+
     # store highest-seen uid per folder
     def lastseen(self, folder, uid=None):
-        if uid is None: # retrieve uid
-            result = self.db.execute("SELECT lastseen FROM folders WHERE folder = ?", (folder,)).fetchone()
-            return result[0] or 1 if result else 1
-        else: # otherwise store as lastseen
-            self.db.execute("""INSERT INTO folders (folder, lastseen) VALUES (?, ?)
-                ON CONFLICT (folder) DO UPDATE SET lastseen = excluded.lastseen""", (folder, uid))
+        with self.lock:
+            if uid is None: # retrieve uid
+                if folder in self._lastseen:
+                    return self._lastseen[folder]
+                result = self.db.execute("SELECT lastseen FROM folders WHERE folder = ?", (folder,)).fetchone()
+                return result[0] or 1 if result else 1
+            else: # otherwise remember until next flush
+                self._lastseen[folder] = uid
+
+    # store the highest modseq of a completely archived folder; the stored
+    # value is only returned if the folder's uidvalidity did not change
+    def modseq(self, folder, uidvalidity, modseq=None):
+        with self.lock:
+            if modseq is None: # retrieve modseq
+                if folder in self._modseqs:
+                    validity, modseq = self._modseqs[folder]
+                else:
+                    result = self.db.execute("SELECT uidvalidity, modseq FROM folders WHERE folder = ?", (folder,)).fetchone()
+                    validity, modseq = result if result else (None, None)
+                return modseq if validity == uidvalidity else None
+            else: # otherwise remember until next flush
+                self._modseqs[folder] = (uidvalidity, modseq)
+
+    # store the uidvalidity of a folder; when it differs from the stored one,
+    # the lastseen uid and modseq are void and the folder starts over at uid 1
+    def uidvalidity(self, folder, uidvalidity=None):
+        with self.lock:
+            if uidvalidity is None: # retrieve uidvalidity
+                if folder in self._modseqs:
+                    return self._modseqs[folder][0]
+                result = self.db.execute("SELECT uidvalidity FROM folders WHERE folder = ?", (folder,)).fetchone()
+                return result[0] if result else None
+            else: # otherwise remember until next flush
+                stored = self.uidvalidity(folder)
+                if stored == uidvalidity:
+                    return
+                if stored is not None:
+                    self.log(INFO, "uidvalidity of {} changed, starting at uid 1".format(folder))
+                    self._lastseen[folder] = 1
+                self._modseqs[folder] = (uidvalidity, None)
 
     # check if a message is already in the archive by checking header digest
     def __contains__(self, message):
         if not isinstance(message, Message):
             message = Message(message)
-        return self.db.execute("SELECT 1 FROM messages WHERE digest = ?", (message.digest(),)).fetchone() != None
-
-    # return a maildir instance for an inbox folder
-    @functools.lru_cache(maxsize=8)
+        return self.indexed(message.digest())
+
+    # check if a header digest is already in the archive
+    def indexed(self, digest):
+        with self.lock:
+            if digest in self._pendingdigests:
+                return True
+            return self.db.execute("SELECT 1 FROM messages WHERE digest = ?", (digest,)).fetchone() != None
+
+    # load the set of digests already stored for a folder at once
+    def digests(self, folder):
+        with self.lock:
+            return set(digest for (digest,) in self.db.execute(
+                "SELECT digest FROM messages WHERE folder = ?", (self.folderid(folder),)))
+
+    # return a cached maildir instance for an inbox folder
     def inbox(self, folder):
-        # quote a folder name with urlencode to make it safe(r)
-        if self.quoting:
-            folder = urllib.parse.quote_plus(folder)
-        folder = folder.replace("/", ".")
-        self.log(VERBOSE, "open mailbox in {!r}".format(folder))
-        return Maildir(os.path.join(self.path, folder), create=True)
-
-    # archive a message in mailbox
-    def store(self, folder, message, uid=0):
+        with self._inboxlock:
+            if folder not in self._inboxes:
+                # quote a folder name with urlencode to make it safe(r)
+                name = urllib.parse.quote_plus(folder) if self.quoting else folder
+                name = name.replace("/", ".")
+                self.log(VERBOSE, "open mailbox in {!r}".format(name))
+                self._inboxes[folder] = Maildir(os.path.join(self.path, name), create=True)
+            return self._inboxes[folder]
+
+    # archive a message in mailbox; give the message header and an iterable of
+    # raw chunks to stream a large message to disk without assembling it first
+    def store(self, folder, message, uid=0, chunks=None):
         if not isinstance(message, Message):
             message = Message(message)
-        if message in self:
-            raise FileExistsError("message already in index")
-        inbox = self.inbox(folder)
-        file = inbox.add(message, uid)
-        self.lastseen(folder, uid)
-        self.db.execute("""INSERT INTO messages (digest, folder, uid) VALUES
-            (?, (SELECT id FROM folders WHERE folder = ?), ?)""", (message.digest(), folder, uid))
-        self.db.commit()
-        self.log(INFO, "message uid {} stored in {}".format(uid, file))
+        # reserve the digest while writing, so concurrent workers do not store it twice
+        with self.lock:
+            if message in self:
+                raise FileExistsError("message already in index")
+            self._pendingdigests.add(message.digest())
+        try:
+            file = self.inbox(folder).add(message, uid, chunks)
+        except FileExistsError:
+            # written by an interrupted run before its index row was flushed; files
+            # only appear in cur/ once complete and the name encodes uid and digest,
+            # so only the row needs to be added
+            file = message.uniqname(uid)
+            self.log(WARNING, "message uid {} found unindexed in {}".format(uid, file))
+        except:
+            with self.lock:
+                self._pendingdigests.discard(message.digest())
+            raise
+        with self.lock:
+            self.lastseen(folder, uid)
+            self._pending.append((message.digest(), self.folderid(folder), uid))
+            self.log(INFO, "message uid {} stored in {}".format(uid, file))
+            if len(self._pending) >= self.BATCHSIZE:
+                self.flush()
         return message.digest()
 
 
@@ -271,12 +621,52 @@ class Account:
         self.username = section.get("username")
         self.password = section.get("password")
         self.quoting = section.get("quoting", False)
+        self.connections = section.getint("connections", 1)
+        # logged in connections which are kept for reuse until close()
+        self._idle = [ ]
+        self._idlelock = threading.Lock()
 
-    # yield a mailserver connection from credentials
+    # yield a mailserver connection from credentials, reusing an idle one if it
+    # still responds; it is kept open for reuse unless an error occurred
     @contextlib.contextmanager
     def imap(self):
-        with Mailserver(self.server, self.username, self.password, self.logger) as ms:
-            yield ms
+        ms = self.__checkout()
+        try: yield ms
+        except:
+            ms.close()
+            raise
+        with self._idlelock:
+            self._idle.append(ms)
+
+    # take an idle connection or open a new one
+    def __checkout(self):
+        while True:
+            with self._idlelock:
+                if not self._idle:
+                    break
+                ms = self._idle.pop()
+            if ms.alive():
+                return ms
+            ms.close()
+        return Mailserver(self.server, self.username, self.password, self.logger)
+
+    # log out of all idle connections
+    def close(self):
+        with self._idlelock:
+            idle, self._idle = self._idle, [ ]
+        for ms in idle:
+            ms.close()
+
+    # yield a queue of size connections for concurrent workers, reusing any given ones
+    @contextlib.contextmanager
+    def pool(self, size, *existing):
+        with contextlib.ExitStack() as stack:
+            pool = queue.Queue()
+            for ms in existing:
+                pool.put(ms)
+            for _ in range(size - len(existing)):
+                pool.put(stack.enter_context(self.imap()))
+            yield pool
 
     # yield an archive instance at path
     @contextlib.contextmanager
@@ -295,7 +685,7 @@ class Account:
 # -----------------------------------------------------------------------------------
 def commandline():
 
-    import argparse, configparser, fnmatch
+    import argparse, configparser, fnmatch, re
     parser = argparse.ArgumentParser(description="imapfetch {}".format(__version__))
     parser.add_argument("config", help="configuration file", type=argparse.FileType("r"))
     parser.add_argument("section", help="sections to execute", nargs="*")
@@ -304,7 +694,13 @@ def commandline():
     parser.add_argument("--verbose", "-v", help="increase logging verbosity", action="count", default=1)
     parser.add_argument("--start-date", dest="start_date", help="start date for filtering messages (YYYY-MM-DD)")
     parser.add_argument("--end-date", dest="end_date", help="end date for filtering messages (YYYY-MM-DD)")
+    parser.add_argument("--interval", "-i", help="repeat every INTERVAL seconds and keep connections open", type=float)
+    parser.add_argument("--idle", help="with --interval, start early on new mail in the inbox of a single account", action="store_true")
     args = parser.parse_args()
+    if args.interval is not None and not args.interval > 0:
+        parser.error("--interval must be a positive number of seconds")
+    if args.idle and args.interval is None:
+        parser.error("--idle requires --interval")
 
     # calculate start_date and end_date if provided
     start_date = datetime.datetime.strptime(args.start_date, "%Y-%m-%d").date() if args.start_date else None
@@ -328,76 +724,212 @@ def commandline():
             applog(ERROR, "no such section in configuration: {}".format(section))
             sys.exit(1)
 
-    # iterate over selected configuration sections
-    errors = { }
-    for section in (args.section or conf.sections()):
-
-        # create logger
-        applog(INFO, "processing section {}".format(section))
-        logger = logging.getLogger(section)
-        log = logger.log
-
-        try:
-
-            # if --list is given only connect and show folders
-            if args.list:
-                with Account(conf[section], logger).imap() as mailserver:
-                    log(INFO, "listing folders:")
-                    for folder in mailserver.ls():
-                        log(WARNING, folder)
-                continue
-
-            # otherwise open archive for processing
-            with Account(conf[section], logger).ctx() as (acc, mailserver, archive):
-                for folder in mailserver.ls():
+    # accounts are kept across repeated runs to reuse their connections
+    repeat = args.interval and not args.list
+    accounts = { }
+    def account(section, logger):
+        if section not in accounts:
+            accounts[section] = Account(conf[section], logger)
+        return accounts[section]
+
+    # process all selected sections once, return errors per section
+    def run():
+        # iterate over selected configuration sections
+        errors = { }
+        for section in (args.section or conf.sections()):
+
+            # create logger
+            applog(INFO, "processing section {}".format(section))
+            logger = logging.getLogger(section)
+            log = logger.log
+
+            try:
+
+                # if --list is given only connect and show folders
+                if args.list:
+                    with account(section, logger).imap() as mailserver:
+                        log(INFO, "listing folders:")
+                        for folder in mailserver.ls():
+                            log(WARNING, folder)
+                    continue
+
+                # otherwise open archive for processing
+                with account(section, logger).ctx() as (acc, mailserver, archive):
+
+                    # compile exclusion patterns once per account
+                    def compilerules(patterns):
+                        rules = [ ]
+                        for pattern in patterns:
+                            # common pattern fix for gmail
+                            if pattern.startswith("[Gmail]"):
+                                pattern = "[[]Gmail[]]" + pattern[7:]
+                            rules.append((pattern, re.compile(fnmatch.translate(pattern)).match))
+                        return rules
 
                     # test for exclusion matches
                     def checkskip(rules, folder):
                         if folder == "[Gmail]":
                             log(VERBOSE, "excluded [Gmail] folder")
                             return True
-                        for pattern in rules:
-                            # common pattern fix for gmail
-                            if pattern.startswith("[Gmail]"):
-                                pattern = "[[]Gmail[]]" + pattern[7:]
-                            if fnmatch.fnmatch(folder, pattern):
+                        for pattern, match in rules:
+                            if match(folder):
                                 log(VERBOSE, "excluded folder {} due to {!r}".format(folder, pattern))
                                 return True
-                    if checkskip(acc.exclude, folder):
-                        continue
-
-                    # send imap command to change directory 
-                    log(INFO, "processing folder {}".format(folder))
-                    mailserver.cd(folder)
-
-                    # retrieve the highest known uid from index
-                    highest = archive.lastseen(folder)
-                    log(VERBOSE, "lastseen uid for {} = {}".format(folder, highest))
-                    if args.full:
-                        log(INFO, "starting at uid 1")
-
-                    # iterate over all uids >= highest
-                    for uid in mailserver.mails(1 if args.full else highest, start_date=start_date, end_date=end_date):
-                        header, size, generator = mailserver.message(uid)
-                        
-                        # check if the email is stored already
-                        if header in archive:
-                            log(VERBOSE, "message uid {} stored already".format(uid))
-                            archive.lastseen(folder, uid)
-                        else:
-                            # otherwise collect full message and store
-                            message = b"".join(generator())
-                            archive.store(folder, message, uid)
 
-        except Exception as err:
-            errors[section] = err
-            logger.exception(err)
-        
-    if len(errors.keys()):
-        applog(ERROR, "encountered errors!")
-        for section, err in errors.items():
-            applog(ERROR, "{}: {!r}".format(section, err))
-        sys.exit(1)
+                    # set when a worker failed or the run is interrupted
+                    stop = threading.Event()
+
+                    # archive new messages of a single folder on the given connection
+                    def process(mailserver, folder):
+
+                        # send imap command to change directory 
+                        log(INFO, "processing folder {}".format(folder))
+                        status = mailserver.cd(folder)
+
+                        # uids are only comparable within one uidvalidity, otherwise start over
+                        validity, modseq = status.get(b"UIDVALIDITY"), status.get(b"HIGHESTMODSEQ")
+                        if validity is not None:
+                            archive.uidvalidity(folder, validity)
+
+                        # with condstore, skip folders that did not change since the last run
+                        since = None
+                        if mailserver.condstore and modseq is not None and not args.full:
+                            since = archive.modseq(folder, validity)
+                            if since is not None and since >= modseq:
+                                log(VERBOSE, "folder {} unchanged since modseq {}".format(folder, since))
+                                return
+
+                        # retrieve the highest known uid from index
+                        highest = archive.lastseen(folder)
+                        log(VERBOSE, "lastseen uid for {} = {}".format(folder, highest))
+                        if args.full:
+                            log(INFO, "starting at uid 1")
+
+                        # iterate over all uids >= highest, unless the folder is empty or
+                        # its next uid shows that no messages were added since the last run
+                        uidnext = status.get(b"UIDNEXT")
+                        if status.get(b"EXISTS") == 0 or (not args.full and uidnext is not None and 1 < highest >= uidnext - 1):
+                            log(VERBOSE, "no new uids in folder {}".format(folder))
+                            uids = [ ]
+                        else:
+                            uids = mailserver.mails(1 if args.full else highest, start_date=start_date, end_date=end_date, modseq=since)
+
+                        # prefetch digests in this folder to skip most index lookups
+                        known = archive.digests(folder) if uids else set()
+                        for part, headers in mailserver.headers(uids):
+                            if stop.is_set():
+                                break
+
+                            # check if the emails are stored already, in this folder or elsewhere
+                            missing = { }
+                            for uid in part:
+                                if uid not in headers:
+                                    continue
+                                message = Message(headers[uid][mailserver.HEADER])
+                                if message.digest() in known or archive.indexed(message.digest()):
+                                    log(VERBOSE, "message uid {} stored already".format(uid))
+                                else:
+                                    missing[uid] = message
+
+                            # otherwise fetch the bodies and stream the full messages to disk,
+                            # sizing the first chunk from the sizes returned with the headers
+                            firstflight = mailserver.firstflight(headers[uid][mailserver.SIZE] for uid in missing)
+                            for uid, header, size, generator in mailserver.messages(list(missing), firstflight, headers=headers):
+                                if stop.is_set():
+                                    break
+                                message = missing[uid]
+                                try: known.add(archive.store(folder, message, uid, generator()))
+                                except FileExistsError:
+                                    # stored just now, through another worker or a duplicate uid
+                                    if not archive.indexed(message.digest()):
+                                        raise
+                                    log(VERBOSE, "message uid {} stored already".format(uid))
+                                    archive.lastseen(folder, uid)
+
+                            # all messages of this batch are archived now
+                            if not stop.is_set():
+                                archive.lastseen(folder, part[-1])
+
+                        # remember modseq only if the folder was archived completely
+                        if modseq is not None and not stop.is_set() and not (start_date or end_date):
+                            archive.modseq(folder, validity, modseq)
+
+                        # commit index updates once per folder
+                        archive.flush()
+
+                    rules = compilerules(acc.exclude)
+                    folders = [f for f in mailserver.ls() if not checkskip(rules, f)]
+                    workers = min(acc.connections, len(folders))
+                    if workers > 1:
+
+                        # process folders concurrently with one connection per worker
+                        with acc.pool(workers, mailserver) as pool, \
+                            concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                            def worker(folder):
+                                ms = pool.get()
+                                try: process(ms, folder)
+                                finally: pool.put(ms)
+                            jobs = [executor.submit(worker, folder) for folder in folders]
+                            try:
+                                for job in jobs:
+                                    job.result()
+                            except BaseException:
+                                stop.set()
+                                for job in jobs:
+                                    job.cancel()
+                                raise
+
+                    else:
+                        for folder in folders:
+                            process(mailserver, folder)
+
+            except Exception as err:
+                errors[section] = err
+                logger.exception(err)
+
+            finally:
+                # close connections unless they are reused in the next run
+                if not repeat and section in accounts:
+                    accounts[section].close()
+
+        return errors
+
+    # wait until the next run; a single account can wait in IDLE on its inbox
+    # instead, which starts the next run early when new mail arrives
+    def wait(interval):
+        if args.idle and len(accounts) == 1:
+            acc, = accounts.values()
+            try:
+                with acc.imap() as ms:
+                    if ms.client.has_capability("IDLE"):
+                        if ms.idle("INBOX", interval):
+                            applog(INFO, "new mail in INBOX")
+                        return
+                    applog(WARNING, "server does not support IDLE")
+            except Exception as err:
+                applog(WARNING, "IDLE failed: {!r}".format(err))
+        time.sleep(interval)
+
+    # repeat with --interval; connections stay open in between
+    try:
+        while True:
+            errors = run()
+
+            if len(errors.keys()):
+                applog(ERROR, "encountered errors!")
+                for section, err in errors.items():
+                    applog(ERROR, "{}: {!r}".format(section, err))
+                if not repeat:
+                    sys.exit(1)
+
+            if not repeat:
+                break
+            applog(INFO, "next run in {} seconds".format(args.interval))
+            wait(args.interval)
+
+    finally:
+        for acc in accounts.values():
+            acc.close()
 
 
 if __name__ == "__main__":